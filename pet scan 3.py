@@ -1,5 +1,11 @@
+import math
+from dataclasses import dataclass
+
 import numpy as np
 import matplotlib.pyplot as plt
+from matplotlib.collections import LineCollection
+from numba import cuda, float32, float64, guvectorize, njit
+from numba.cuda.random import create_xoroshiro128p_states, xoroshiro128p_uniform_float32
 
 # Constants
 NUM_DETECTORS = 50          # Number of detectors in the ring
@@ -7,104 +13,206 @@ NUM_EVENTS = 1000           # Number of photon emission events
 SOURCE_RADIUS = 0.5         # Radius of the source region (phantom model)
 DETECTOR_RADIUS = 5         # Radius of the detector ring
 CORRELATED_PROB = 0.7       # Probability that a photon pair is correlated
+CHUNK_SIZE = 1 << 16        # Events simulated per batch (keeps a batch in cache)
+GPU_THREADS = 256           # Threads per block for the CUDA simulator
+OUTPUT_FILE = 'pet_scan_3.png'  # Where the plots are saved on a headless (Agg) backend
+
+# Coordinates never exceed DETECTOR_RADIUS, so single precision is plenty
+DTYPE = np.float32
+PI = DTYPE(np.pi)
+TWO_PI = DTYPE(2 * np.pi)
+DETECTOR_RADIUS_SQ = DTYPE(DETECTOR_RADIUS**2)
+SOURCE_RADIUS_F32 = DTYPE(SOURCE_RADIUS)
+CORRELATED_PROB_F32 = DTYPE(CORRELATED_PROB)
+BACK_TO_BACK = DTYPE(np.pi - np.pi/4)  # Smallest |delta-phi| of a back-to-back pair
+
+# Random number generator (PCG64), seeded so runs are reproducible
+rng = np.random.default_rng(42)
+
+# Detected photon pairs, stored as one float32 array per coordinate
+@dataclass
+class Events:
+    x1: np.ndarray
+    y1: np.ndarray
+    x2: np.ndarray
+    y2: np.ndarray
+    corr: np.ndarray
 
-# Helper function to simulate photon emission
-def generate_photon_pair():
-    angle = np.random.uniform(0, 2 * np.pi)
-    x_source = SOURCE_RADIUS * np.cos(angle)
-    y_source = SOURCE_RADIUS * np.sin(angle)
-    return (x_source, y_source)
+    def __len__(self):
+        return len(self.x1)
 
-# Function to calculate intersection of a photon line with the detector ring
+    # Select a subset of events with a boolean mask or index array
+    def __getitem__(self, index):
+        return Events(self.x1[index], self.y1[index], self.x2[index], self.y2[index], self.corr[index])
+
+    # Join several batches of events back into one (no batches gives no events)
+    @staticmethod
+    def concatenate(batches):
+        if not batches:
+            empty = np.empty(0, dtype=DTYPE)
+            return Events(empty, empty, empty, empty, np.empty(0, dtype=np.bool_))
+        return Events(np.concatenate([b.x1 for b in batches]), np.concatenate([b.y1 for b in batches]),
+                      np.concatenate([b.x2 for b in batches]), np.concatenate([b.y2 for b in batches]),
+                      np.concatenate([b.corr for b in batches]))
+
+# Function to calculate where a photon leaving the source hits the detector ring
+# (compiled)
+@njit(fastmath=True, cache=True)
 def photon_to_detector(x_source, y_source, angle):
-    dx = np.cos(angle)
-    dy = np.sin(angle)
+    dx = math.cos(angle)
+    dy = math.sin(angle)
     
-    a = dx**2 + dy**2
-    b = 2 * (x_source * dx + y_source * dy)
-    c = x_source**2 + y_source**2 - DETECTOR_RADIUS**2
-    discriminant = b**2 - 4 * a * c
+    # (dx, dy) is a unit vector, so the quadratic in t has a = 1 and we
+    # can work with b/2 directly
+    half_b = x_source * dx + y_source * dy
+    c = x_source * x_source + y_source * y_source - DETECTOR_RADIUS_SQ
+    # The source lies inside the ring, so c < 0 and the discriminant is
+    # always positive: every photon hits the ring
+    discriminant = half_b * half_b - c
     
-    if discriminant < 0:
-        return None, None
+    # The photon travels forward along its direction, i.e. the positive root
+    t = -half_b + math.sqrt(discriminant)
     
-    sqrt_discriminant = np.sqrt(discriminant)
-    t1 = (-b - sqrt_discriminant) / (2 * a)
-    t2 = (-b + sqrt_discriminant) / (2 * a)
+    return x_source + t * dx, y_source + t * dy
+
+# The same intersection kernel compiled as a CUDA device function
+photon_to_detector_gpu = cuda.jit(device=True)(photon_to_detector.py_func)
+
+# Function to detect photons for whole arrays of sources and angles at once
+# (a compiled, multi-threaded NumPy ufunc around photon_to_detector)
+@guvectorize([(float32, float32, float32, float32[:], float32[:]),
+              (float64, float64, float64, float64[:], float64[:])], '(),(),()->(),()', target='parallel', cache=True)
+def detect_photons(x_source, y_source, angle, x, y):
+    x[0], y[0] = photon_to_detector(x_source, y_source, angle)
+
+# Function to filter photon pairs based on angular correlation (delta-phi)
+def filter_photons(events):
+    # Calculate the angle between the lines
+    delta_phi = np.arctan2(events.y2 - events.y1, events.x2 - events.x1)
+    # arctan2 wraps at +/-pi, so "within pi/4 of pi" is |delta_phi| >= 3pi/4
+    back_to_back = np.abs(delta_phi) >= BACK_TO_BACK
+    keep = back_to_back | ~events.corr
+    return events[keep]
+
+# Drawing the random variables for a batch of events
+def draw_events(num_events):
+    src_angle = rng.uniform(0, TWO_PI, num_events).astype(DTYPE, copy=False)
+    x_source = SOURCE_RADIUS * np.cos(src_angle)
+    y_source = SOURCE_RADIUS * np.sin(src_angle)
+    
+    angle1 = rng.uniform(0, TWO_PI, num_events).astype(DTYPE, copy=False)
+    corr = rng.random(num_events) < CORRELATED_PROB
+    
+    # Sample both candidates for the second photon and blend them, so no
+    # event takes a separate branch
+    # angle1 is in [0, 2pi), so one conditional subtract replaces the modulo
+    angle2_corr = np.where(angle1 < PI, angle1 + PI, angle1 - PI)
+    angle2_rand = rng.uniform(0, TWO_PI, num_events).astype(DTYPE, copy=False)
+    angle2 = np.where(corr, angle2_corr, angle2_rand)
+    
+    return x_source, y_source, angle1, angle2, corr
+
+# Simulation: Generating all events in one batch and detecting the photons
+def simulate(num_events):
+    x_source, y_source, angle1, angle2, corr = draw_events(num_events)
     
-    x1 = x_source + t1 * dx
-    y1 = y_source + t1 * dy
-    x2 = x_source + t2 * dx
-    y2 = y_source + t2 * dy
+    x1, y1 = detect_photons(x_source, y_source, angle1)
+    x2, y2 = detect_photons(x_source, y_source, angle2)
     
-    return (x1, y1), (x2, y2)
+    return Events(x1, y1, x2, y2, corr)
 
-# Function to detect photons and simulate scattering or randomness
-def detect_photons(x_source, y_source, correlated=True):
-    angle1 = np.random.uniform(0, 2 * np.pi)
-    photon1, _ = photon_to_detector(x_source, y_source, angle1)
+# CUDA kernel: each GPU thread simulates one event with its own RNG stream
+@cuda.jit
+def simulate_kernel(x1, y1, x2, y2, corr, rng_states):
+    i = cuda.grid(1)
+    if i >= x1.size:
+        return
     
-    if correlated:
-        angle2 = (angle1 + np.pi) % (2 * np.pi)
-    else:
-        angle2 = np.random.uniform(0, 2 * np.pi)
+    src_angle = xoroshiro128p_uniform_float32(rng_states, i) * TWO_PI
+    x_source = SOURCE_RADIUS_F32 * math.cos(src_angle)
+    y_source = SOURCE_RADIUS_F32 * math.sin(src_angle)
     
-    photon2, _ = photon_to_detector(x_source, y_source, angle2)
+    angle1 = xoroshiro128p_uniform_float32(rng_states, i) * TWO_PI
+    corr[i] = xoroshiro128p_uniform_float32(rng_states, i) < CORRELATED_PROB_F32
+    angle2_corr = angle1 + PI if angle1 < PI else angle1 - PI
+    angle2_rand = xoroshiro128p_uniform_float32(rng_states, i) * TWO_PI
+    angle2 = angle2_corr if corr[i] else angle2_rand
     
-    return photon1, photon2
+    x1[i], y1[i] = photon_to_detector_gpu(x_source, y_source, angle1)
+    x2[i], y2[i] = photon_to_detector_gpu(x_source, y_source, angle2)
 
-# Function to filter photon pairs based on angular correlation (delta-phi)
-def filter_photons(event_data):
-    filtered_data = []
-    for event in event_data:
-        (x1, y1), (x2, y2), correlated = event
-        if (x1 is not None and y1 is not None and x2 is not None and y2 is not None):
-            # Calculate the angle between the lines
-            delta_phi = np.arctan2(y2 - y1, x2 - x1)
-            if correlated and (abs(delta_phi) >= np.pi - np.pi/4 and abs(delta_phi) <= np.pi + np.pi/4):
-                filtered_data.append(((x1, y1), (x2, y2)))
-            elif not correlated:
-                filtered_data.append(((x1, y1), (x2, y2)))
-    return filtered_data
-
-# Simulation loop: Generating events and detecting photons
-event_data = []
-for _ in range(NUM_EVENTS):
-    x_source, y_source = generate_photon_pair()
-    correlated = np.random.uniform() < CORRELATED_PROB
-    
-    photon1, photon2 = detect_photons(x_source, y_source, correlated)
-    event_data.append((photon1, photon2, correlated))
-
-# Filter the events based on our "entanglement" (angular correlation) concept
-filtered_events = filter_photons(event_data)
-
-# Visualization
-def plot_events(events, title):
-    plt.figure(figsize=(8, 8))
+# Simulation on the GPU, used instead of simulate when CUDA is available
+def simulate_cuda(num_events):
+    x1 = cuda.device_array(num_events, dtype=DTYPE)
+    y1 = cuda.device_array(num_events, dtype=DTYPE)
+    x2 = cuda.device_array(num_events, dtype=DTYPE)
+    y2 = cuda.device_array(num_events, dtype=DTYPE)
+    corr = cuda.device_array(num_events, dtype=np.bool_)
+    
+    # Seed the per-thread streams from rng so runs stay reproducible
+    rng_states = create_xoroshiro128p_states(num_events, seed=int(rng.integers(2**63)))
+    blocks = (num_events + GPU_THREADS - 1) // GPU_THREADS
+    simulate_kernel[blocks, GPU_THREADS](x1, y1, x2, y2, corr, rng_states)
+    
+    return Events(x1.copy_to_host(), y1.copy_to_host(), x2.copy_to_host(), y2.copy_to_host(), corr.copy_to_host())
+
+# Run the simulation in cache-sized chunks, filtering each chunk while it is
+# still hot, and join the results at the end. Detection and filtering stay
+# separate passes: the unfiltered events are plotted anyway, and a fused
+# compiled pass measured slower than detect_photons + filter_photons
+def run_simulation(num_events, chunk_size=CHUNK_SIZE):
+    use_gpu = cuda.is_available()
+    if use_gpu:
+        # The GPU wants one large launch, and its RNG states are built on the
+        # host, so run everything as a single chunk there
+        chunk_size = max(num_events, 1)
+    all_chunks = []
+    filtered_chunks = []
+    for start in range(0, num_events, chunk_size):
+        chunk_events = min(chunk_size, num_events - start)
+        events = simulate_cuda(chunk_events) if use_gpu else simulate(chunk_events)
+        all_chunks.append(events)
+        # Filter the events based on our "entanglement" (angular correlation) concept
+        filtered_chunks.append(filter_photons(events))
+    
+    return Events.concatenate(all_chunks), Events.concatenate(filtered_chunks)
+
+event_data, filtered_events = run_simulation(NUM_EVENTS)
+
+# Visualization (draws into the given axes; the caller owns the figure)
+def plot_events(ax, events, title):
     circle = plt.Circle((0, 0), DETECTOR_RADIUS, color='b', fill=False)
-    plt.gca().add_artist(circle)
+    ax.add_artist(circle)
     
     source_position = (0, 0)  # Assuming the source is at the origin
     source_circle = plt.Circle(source_position, SOURCE_RADIUS, color='g', fill=False, linestyle='dotted', linewidth=2)
-    plt.gca().add_artist(source_circle)
-
-    for (x1, y1), (x2, y2) in events:
-        if x1 is not None and y1 is not None and x2 is not None and y2 is not None:
-            plt.plot([x1, x2], [y1, y2], 'r-', alpha=0.3)  # Line between detectors
-            plt.plot(x1, y1, 'go')  # Detector hit
-            plt.plot(x2, y2, 'go')  # Detector hit
-
-    plt.xlim([-DETECTOR_RADIUS-1, DETECTOR_RADIUS+1])
-    plt.ylim([-DETECTOR_RADIUS-1, DETECTOR_RADIUS+1])
-    plt.title(title)
-    plt.gca().set_aspect('equal', adjustable='box')
-    plt.grid(True)
-    plt.show()
+    ax.add_artist(source_circle)
+
+    # Lines between detectors, drawn as one (N, 2, 2) collection
+    segments = np.stack([np.stack([events.x1, events.y1], axis=1), np.stack([events.x2, events.y2], axis=1)], axis=1)
+    ax.add_collection(LineCollection(segments, colors='r', alpha=0.3))
+    
+    # Detector hits for both photons, drawn as one scatter
+    ax.scatter(np.concatenate([events.x1, events.x2]), np.concatenate([events.y1, events.y2]), c='g', s=12, zorder=2)
+
+    ax.set_xlim([-DETECTOR_RADIUS-1, DETECTOR_RADIUS+1])
+    ax.set_ylim([-DETECTOR_RADIUS-1, DETECTOR_RADIUS+1])
+    ax.set_title(title)
+    ax.set_aspect('equal', adjustable='box')
+    ax.grid(True)
     
 
+# One figure for both plots
+fig, axes = plt.subplots(1, 2, figsize=(16, 8))
+
 # Plot unfiltered events
-plot_events([(p1, p2) for p1, p2, _ in event_data], title="Unfiltered PET Events (Including Noise)")
+plot_events(axes[0], event_data, title="Unfiltered PET Events (Including Noise)")
 
 # Plot filtered events (correlated photons only)
-plot_events(filtered_events, title="Filtered PET Events (Correlated Photons)")
+plot_events(axes[1], filtered_events, title="Filtered PET Events (Correlated Photons)")
+
+# Headless runs (e.g. MPLBACKEND=Agg) have no window to show, so save instead
+if plt.get_backend().lower() == 'agg':
+    fig.savefig(OUTPUT_FILE)
+else:
+    plt.show()